@@ -1,131 +1,339 @@
 import os
 import json
+import heapq
+import logging
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+import aiohttp
+import numpy as np
+from scipy.spatial import cKDTree
 import requests
-from pymongo import MongoClient
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pymongo import ReturnDocument, UpdateMany, InsertOne
+from pymongo.errors import OperationFailure
 from dotenv import load_dotenv
-from geopy.distance import geodesic
+from dbconn import async_client, async_db
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 ORS_API_KEY = os.getenv("ORS_API_KEY")
-MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
-
-client = MongoClient(MONGO_URI)
-db = client.proximity_dispatch
-
-def load_customer_agent(state):
+EARTH_RADIUS_KM = 6371.0088
+DISTANCE_CACHE_SIZE = 100_000
+NEAREST_K = 10
+TECH_INDEX_RECHECK_S = float(os.getenv("TECH_INDEX_RECHECK_S", "1.0"))
+LLM_TIEBREAK_THRESHOLD_KM = float(os.getenv("LLM_TIEBREAK_THRESHOLD_KM", "1.0"))
+
+# Shared HTTP session so Groq calls reuse pooled TCP/TLS connections.
+# Only gateway errors are retried (POST included, since no completion was produced);
+# read=0 so a slow completion is never re-sent and billed again after the timeout.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, read=0, backoff_factor=0.2, status_forcelist=[502, 503, 504], allowed_methods=["GET", "POST"])
+))
+
+# Customers and technicians don't move between dispatches, so routed distances
+# are cached per (customer, technician) coordinate pair, LRU-evicted.
+_distance_cache = OrderedDict()
+_distance_cache_lock = threading.Lock()
+
+def _distance_key(customer_coord, tech_coord):
+    return (round(customer_coord[0], 5), round(customer_coord[1], 5), round(tech_coord[0], 5), round(tech_coord[1], 5))
+
+def get_cached_distance(customer_coord, tech_coord):
+    key = _distance_key(customer_coord, tech_coord)
+    with _distance_cache_lock:
+        hit = _distance_cache.get(key)
+        if hit is not None:
+            _distance_cache.move_to_end(key)
+        return hit
+
+def cache_distance(customer_coord, tech_coord, distance, method):
+    key = _distance_key(customer_coord, tech_coord)
+    with _distance_cache_lock:
+        _distance_cache[key] = (distance, method)
+        _distance_cache.move_to_end(key)
+        if len(_distance_cache) > DISTANCE_CACHE_SIZE:
+            _distance_cache.popitem(last=False)
+
+# Spatial index over free technicians so only the NEAREST_K closest (as the
+# crow flies) are sent on to road routing. Freeing a technician bumps a shared
+# version document, so every worker process rebuilds before its next dispatch.
+# Assigned technicians stay in the tree; the is_free filter on the $in query
+# skips them.
+_tech_tree = None
+_tech_ids = []
+_tech_version = None        # shared version the current tree was built from
+_tech_generation = 0        # bumped by every local invalidation
+_tech_checked = (-1, 0.0)   # (generation, monotonic time) of the last version check
+_tech_tree_lock = asyncio.Lock()
+
+def _unit_vectors(lats, lons):
+    # Points on the unit sphere: chord distance orders the same as great-circle distance
+    phi, lam = np.radians(lats), np.radians(lons)
+    return np.column_stack((np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)))
+
+def _as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def _build_tech_tree(techs):
+    # Empty CSV cells arrive as NaN (or None); cKDTree rejects non-finite points,
+    # so those technicians are left out rather than breaking every dispatch
+    lats = np.fromiter((_as_float(t.get("latitude")) for t in techs), dtype=np.float64, count=len(techs))
+    lons = np.fromiter((_as_float(t.get("longitude")) for t in techs), dtype=np.float64, count=len(techs))
+    keep = np.isfinite(lats) & np.isfinite(lons)
+    ids = [t["_id"] for t, ok in zip(techs, keep) if ok]
+    return cKDTree(_unit_vectors(lats[keep], lons[keep])), ids
+
+async def invalidate_tech_index():
+    # Call after a technician is freed (the technician write must come first)
+    global _tech_generation
+    await async_db.counters.update_one({"_id": "free_technicians"}, {"$inc": {"version": 1}}, upsert=True)
+    _tech_generation += 1
+
+async def load_tech_index():
+    global _tech_tree, _tech_ids, _tech_version, _tech_checked
+    async with _tech_tree_lock:
+        generation = _tech_generation
+        checked_generation, checked_at = _tech_checked
+        if (_tech_tree is not None and checked_generation == generation
+                and time.monotonic() - checked_at < TECH_INDEX_RECHECK_S):
+            return _tech_tree, _tech_ids
+
+        # The version is read before the scan, so an invalidation that lands
+        # mid-rebuild leaves us on the old version and forces another rebuild.
+        counter = await async_db.counters.find_one({"_id": "free_technicians"}, {"version": 1})
+        version = counter["version"] if counter else 0
+        if _tech_tree is None or version != _tech_version:
+            techs = await async_db.technicians.find({"is_free": True}, {"latitude": 1, "longitude": 1}).to_list(length=None)
+            # CPU-bound for large fleets; keep it off the event loop serving /recommend
+            _tech_tree, _tech_ids = await asyncio.to_thread(_build_tech_tree, techs)
+            _tech_version = version
+        _tech_checked = (generation, time.monotonic())
+        return _tech_tree, _tech_ids
+
+def _nearest_tech_ids(tree, ids, lat, lon, k):
+    if not ids:
+        return []
+    _, idx = tree.query(_unit_vectors(np.array([lat]), np.array([lon]))[0], k=min(k, len(ids)))
+    return [ids[i] for i in np.atleast_1d(idx)]
+
+async def _find_free_by_ids(ids, projection):
+    if not ids:
+        return []
+    return await async_db.technicians.find({"_id": {"$in": ids}, "is_free": True}, projection).to_list(length=None)
+
+async def find_nearest_free_technicians(lat, lon, projection, k=NEAREST_K):
+    if not (np.isfinite(lat) and np.isfinite(lon)):
+        return []
+    tree, ids = await load_tech_index()
+    # Some of the nearest may have been assigned since the build; widen until k free ones turn up
+    want = k
+    while True:
+        nearest = _nearest_tech_ids(tree, ids, lat, lon, want)
+        techs = await _find_free_by_ids(nearest, projection)
+        if len(techs) >= k or len(nearest) >= len(ids):
+            rank = {tech_id: i for i, tech_id in enumerate(nearest)}
+            return sorted(techs, key=lambda t: rank[t["_id"]])[:k]
+        want *= 2
+
+def needs_llm_tiebreak(top3):
+    # Only worth asking the LLM when the two nearest are close; otherwise nearest wins outright
+    return len(top3) >= 2 and (top3[1]["distance_km"] - top3[0]["distance_km"]) < LLM_TIEBREAK_THRESHOLD_KM
+
+async def load_customer_agent(state):
     ticket = state.ticket
     cust_id = ticket.get("id")
     if cust_id is None:
         raise Exception("Missing customer ID in ticket")
 
-    customer = db.customers.find_one({"customer_id": cust_id})
+    # Warm the free-technician index while the customer lookup is in flight
+    customer, _ = await asyncio.gather(
+        async_db.customers.find_one(
+            {"customer_id": cust_id},
+            {"customer_id": 1, "latitude": 1, "longitude": 1, "name": 1, "_id": 1}
+        ),
+        load_tech_index()
+    )
     if not customer:
         raise Exception(f"Customer with ID {cust_id} not found")
 
     state.customer = customer
     return state
 
-def compute_distance(customer_coord, tech_coord):
+def haversine_km(lat0, lon0, lats, lons):
+    # Great-circle distance from one point to every (lats[i], lons[i]) in a single vectorized pass
+    phi0, lam0 = np.radians(lat0), np.radians(lon0)
+    phi, lam = np.radians(lats), np.radians(lons)
+    a = np.sin((phi - phi0) / 2) ** 2 + np.cos(phi0) * np.cos(phi) * np.sin((lam - lam0) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+# Long-lived aiohttp session so ORS/OSRM TCP+TLS connections are reused across
+# dispatches. Created lazily on the running loop; the API closes it on shutdown.
+_http_session = None
+_http_session_loop = None
+
+def get_http_session():
+    global _http_session, _http_session_loop
+    loop = asyncio.get_running_loop()
+    if _http_session is None or _http_session.closed or _http_session_loop is not loop:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, limit_per_host=32),
+            timeout=aiohttp.ClientTimeout(total=10)
+        )
+        _http_session_loop = loop
+    return _http_session
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+async def compute_distances(session, customer_coord, lats, lons):
+    # One matrix request for all technicians instead of one route request each.
+    # customer_coord is (lat, lon); both routing APIs expect lon,lat.
+    locations = [[customer_coord[1], customer_coord[0]]] + [[lon, lat] for lon, lat in zip(lons.tolist(), lats.tolist())]
+    destinations = list(range(1, len(locations)))
+
     try:
-        # 1. Try OpenRouteService
-        ors_url = "https://api.openrouteservice.org/v2/directions/driving-car"
+        # 1. Try OpenRouteService matrix
+        ors_url = "https://api.openrouteservice.org/v2/matrix/driving-car"
         headers = {"Authorization": ORS_API_KEY, "Content-Type": "application/json"}
-        body = {"coordinates": [[customer_coord[1], customer_coord[0]], [tech_coord[1], tech_coord[0]]]}
+        body = {"locations": locations, "sources": [0], "destinations": destinations, "metrics": ["distance"]}
 
-        res = requests.post(ors_url, json=body, headers=headers, timeout=10)
-        print("\n🚀 ORS status:", res.status_code)
+        async with session.post(ors_url, json=body, headers=headers) as res:
+            log.debug("🚀 ORS status: %s", res.status)
 
-        if res.status_code != 200:
-            print("❌ ORS Error:", res.text)
-            raise Exception("ORS failed")
+            if res.status != 200:
+                log.warning("❌ ORS Error: %s", await res.text())
+                raise Exception("ORS failed")
 
-        data = res.json()
-        meters = data["features"][0]["properties"]["segments"][0]["distance"]
-        distance_km = round(meters / 1000.0, 2)
-        print(f"✅ ORS Distance: {distance_km} km")
-        return distance_km, "ORS"
+            data = await res.json()
+        distances = [round(m / 1000.0, 2) if m is not None else None for m in data["distances"][0]]
+        log.debug("✅ ORS Distances: %s km", distances)
+        return distances, "ORS"
 
     except Exception as e:
-        print(f"⚠️ ORS failed: {e}")
+        log.warning("⚠️ ORS failed: %s", e)
         try:
-            # 2. Try OSM (OSRM)
-            osm_url = f"http://router.project-osrm.org/route/v1/driving/{customer_coord[1]},{customer_coord[0]};{tech_coord[1]},{tech_coord[0]}?overview=false"
-            osm_res = requests.get(osm_url, timeout=10)
-            print("🚀 OSM status:", osm_res.status_code)
-
-            if osm_res.status_code == 200:
-                osm_data = osm_res.json()
-                meters = osm_data["routes"][0]["distance"]
-                distance_km = round(meters / 1000.0, 2)
-                print(f"✅ OSM Distance: {distance_km} km")
-                return distance_km, "OSRM"
-            else:
-                print("❌ OSM Error:", osm_res.text)
+            # 2. Try OSM (OSRM table)
+            coords = ";".join(f"{lon},{lat}" for lon, lat in locations)
+            dests = ";".join(str(i) for i in destinations)
+            osm_url = f"http://router.project-osrm.org/table/v1/driving/{coords}?sources=0&destinations={dests}&annotations=distance"
+            async with session.get(osm_url) as osm_res:
+                log.debug("🚀 OSM status: %s", osm_res.status)
+
+                if osm_res.status == 200:
+                    osm_data = await osm_res.json()
+                    distances = [round(m / 1000.0, 2) if m is not None else None for m in osm_data["distances"][0]]
+                    log.debug("✅ OSM Distances: %s km", distances)
+                    return distances, "OSRM"
+                else:
+                    log.warning("❌ OSM Error: %s", await osm_res.text())
         except Exception as e2:
-            print(f"⚠️ OSM fallback failed: {e2}")
+            log.warning("⚠️ OSM fallback failed: %s", e2)
 
-        try:
-            # 3. Try Geopy
-            distance_km = round(geodesic(customer_coord, tech_coord).km, 2)
-            print(f"✅ Geopy Distance: {distance_km} km")
-            return distance_km, "Geopy"
-        except Exception as e3:
-            print(f"❌ Geopy failed: {e3}")
-            return None, "Failed"
-
-def compute_proximity_agent(state):
+    try:
+        # 3. Straight-line haversine for every technician at once
+        distances = np.round(haversine_km(customer_coord[0], customer_coord[1], lats, lons), 2).tolist()
+        log.debug("✅ Haversine Distances: %s km", distances)
+        return distances, "Haversine"
+    except Exception as e3:
+        log.error("❌ Haversine failed: %s", e3)
+        return [None] * len(lats), "Failed"
+
+async def route_distances(customer_coord, tech_coords):
+    # Shared by the graph and the API. Coords are (lat, lon); returns (km, method)
+    # per technician. Cached pairs are answered locally, the rest in one matrix call.
+    results = [get_cached_distance(customer_coord, tech_coord) for tech_coord in tech_coords]
+    misses = [i for i, hit in enumerate(results) if hit is None]
+
+    if misses:
+        lats = np.fromiter((tech_coords[i][0] for i in misses), dtype=np.float64, count=len(misses))
+        lons = np.fromiter((tech_coords[i][1] for i in misses), dtype=np.float64, count=len(misses))
+        distances, method = await compute_distances(get_http_session(), customer_coord, lats, lons)
+
+        for i, distance in zip(misses, distances):
+            results[i] = (distance, method if distance is not None else "Failed")
+            # Only cache real road distances; straight-line fallbacks get retried next time
+            if distance is not None and method in ("ORS", "OSRM"):
+                cache_distance(customer_coord, tech_coords[i], distance, method)
+
+    return results
+
+async def compute_proximity_agent(state):
     customer = state.customer
-    candidates = list(db.technicians.find({"is_free": True}))
+    if not all([customer.get("latitude"), customer.get("longitude")]):
+        raise Exception(f"Customer {customer.get('customer_id')} is missing coordinates")
+
+    candidates = await find_nearest_free_technicians(
+        float(customer["latitude"]), float(customer["longitude"]),
+        {"technician_id": 1, "name": 1, "latitude": 1, "longitude": 1, "_id": 1}
+    )
 
     if not candidates:
         raise Exception("No free technicians available")
 
+    routable = []
     for tech in candidates:
-        try:
-            if not all([
-                customer.get("latitude"), customer.get("longitude"),
-                tech.get("latitude"), tech.get("longitude")
-            ]):
-                raise ValueError("Missing coordinates")
-
-            customer_coord = (float(customer["latitude"]), float(customer["longitude"]))
-            tech_coord = (float(tech["latitude"]), float(tech["longitude"]))
-
-            distance, method = compute_distance(customer_coord, tech_coord)
+        tech["distance_km"] = None
+        tech["distance_method"] = "Failed"
+        if all([tech.get("latitude"), tech.get("longitude")]):
+            routable.append(tech)
+        else:
+            log.warning("⚠️ Failed to compute distance for tech %s: Missing coordinates", tech.get("technician_id"))
+
+    if routable:
+        customer_coord = (float(customer["latitude"]), float(customer["longitude"]))
+        tech_coords = [(float(t["latitude"]), float(t["longitude"])) for t in routable]
+        results = await route_distances(customer_coord, tech_coords)
+
+        for tech, (distance, method) in zip(routable, results):
             tech["distance_km"] = distance
             tech["distance_method"] = method
-            print(f"🧭 Tech {tech['technician_id']} distance: {distance} km via {method}")
+            log.debug("🧭 Tech %s distance: %s km via %s", tech["technician_id"], distance, method)
 
-        except Exception as e:
-            print(f"⚠️ Failed to compute distance for tech {tech.get('technician_id')}: {e}")
-            tech["distance_km"] = None
-            tech["distance_method"] = "Failed"
-
-    sorted_techs = sorted(
-        [t for t in candidates if t["distance_km"] is not None],
+    top3 = heapq.nsmallest(
+        3,
+        (t for t in candidates if t["distance_km"] is not None),
         key=lambda t: t["distance_km"]
     )
-
-    top3 = sorted_techs[:3]
     if not top3:
         raise Exception("No technicians with valid distance computed")
+    state.top3 = top3
+
+    if not needs_llm_tiebreak(top3):
+        state.best = top3[0]
+        state.llm_reason = "Only free technician nearby" if len(top3) == 1 else "Nearest technician by a clear margin"
+        return state
 
+    technician_lines = "\n".join(f'- {t["technician_id"]} {t["name"]} {t["distance_km"]}km' for t in top3)
     prompt = f"""
 You are a smart dispatcher.
-Here are the 3 nearest technicians to a customer based on driving distance.
+Here are the 3 nearest technicians to a customer based on driving distance, one per line as: id name distance.
 Choose the best technician and write the reason.
 
 Technicians:
-{json.dumps([{ "id": t["technician_id"], "name": t["name"], "distance_km": t["distance_km"] } for t in top3], indent=2)}
+{technician_lines}
 
 Respond in JSON:
 {{"id": <best_id>, "reason": "<why>"}}
 """
 
     try:
-        res = requests.post(
+        res = await asyncio.to_thread(
+            SESSION.post,
             "https://api.groq.com/openai/v1/chat/completions",
             headers={
                 "Authorization": f"Bearer {GROQ_API_KEY}",
@@ -139,8 +347,8 @@ Respond in JSON:
             timeout=30
         )
 
-        print("📡 LLM status:", res.status_code)
-        print("📡 LLM response:", res.text)
+        log.debug("📡 LLM status: %s", res.status_code)
+        log.debug("📡 LLM response: %s", res.text)
 
         if res.status_code != 200 or not res.text.strip():
             raise ValueError("LLM returned empty or error response")
@@ -152,51 +360,74 @@ Respond in JSON:
         state.best = chosen
         state.llm_reason = result.get("reason", "Chosen based on proximity")
     except Exception as e:
-        print("❌ LLM selection failed:", e)
+        log.warning("❌ LLM selection failed: %s", e)
         chosen = top3[0]
         state.best = chosen
         state.llm_reason = "LLM failed, assigned first nearest technician"
 
     return state
 
-def assign_agent(state):
+async def assign_agent(state):
     best = state.best
     customer = state.customer
 
-    tech_id = best.get("technician_id")
     cust_id = customer.get("customer_id")
 
-    tech_doc = db.technicians.find_one({"technician_id": tech_id})
-    cust_doc = db.customers.find_one({"customer_id": cust_id})
-
-    db.assignments.update_many({
-        "$or": [
-            {"tech_id": tech_id, "status": "assigned"},
-            {"customer_id": cust_id, "status": "assigned"}
-        ]
-    }, {"$set": {"status": "completed"}})
-
-    db.technicians.update_one({"_id": tech_doc["_id"]}, {
-        "$set": {
-            "is_free": False,
-            "availability_status": "assigned",
-            "assigned_customer": cust_id
-        }
-    })
-
-    db.assignments.insert_one({
-        "customer_id": cust_id,
-        "tech_id": tech_id,
-        "customer_object_id": cust_doc["_id"],
-        "tech_object_id": tech_doc["_id"],
-        "customer_name": cust_doc["name"],
-        "tech_name": tech_doc["name"],
-        "distance_km": best.get("distance_km"),
-        "distance_method": best.get("distance_method"),
-        "llm_reason": state.llm_reason,
-        "status": "assigned"
-    })
-
-    state.best = tech_doc
-    state.customer = cust_doc
+    # Claim the technician atomically; if another dispatch got there first,
+    # fall through to the next nearest of the top 3.
+    ordered = [best] + [t for t in (state.top3 or []) if t["_id"] != best["_id"]]
+
+    async def dispatch(session):
+        for candidate in ordered:
+            tech_doc = await async_db.technicians.find_one_and_update(
+                {"_id": candidate["_id"], "is_free": True},
+                {"$set": {
+                    "is_free": False,
+                    "availability_status": "assigned",
+                    "assigned_customer": cust_id
+                }},
+                projection={"technician_id": 1, "name": 1},
+                return_document=ReturnDocument.AFTER,
+                session=session
+            )
+            if tech_doc:
+                break
+        else:
+            raise Exception("All nearest technicians were assigned by another dispatch")
+
+        llm_reason = state.llm_reason
+        if candidate is not best:
+            llm_reason = f"Technician {best['technician_id']} was taken, assigned next nearest technician"
+        tech_id = candidate.get("technician_id")
+
+        # Close stale assignments and record the new one in a single batch.
+        # Two updates rather than one $or so each hits its own (field, status) index.
+        await async_db.assignments.bulk_write([
+            UpdateMany({"tech_id": tech_id, "status": "assigned"}, {"$set": {"status": "completed"}}),
+            UpdateMany({"customer_id": cust_id, "status": "assigned"}, {"$set": {"status": "completed"}}),
+            InsertOne({
+                "customer_id": cust_id,
+                "tech_id": tech_id,
+                "customer_object_id": customer["_id"],
+                "tech_object_id": candidate["_id"],
+                "customer_name": customer["name"],
+                "tech_name": candidate["name"],
+                "distance_km": candidate.get("distance_km"),
+                "distance_method": candidate.get("distance_method"),
+                "llm_reason": llm_reason,
+                "status": "assigned"
+            })
+        ], ordered=True, session=session)
+        return candidate, llm_reason
+
+    # Claim + assignment writes commit together or not at all
+    try:
+        async with await async_client.start_session() as session:
+            state.best, state.llm_reason = await session.with_transaction(dispatch)
+    except OperationFailure as e:
+        # Standalone mongod (e.g. local dev) has no transactions; the claim itself is still atomic
+        if e.code != 20:
+            raise
+        state.best, state.llm_reason = await dispatch(None)
+
     return state
@@ -0,0 +1,10 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Connection settings shared by dbconn (API/graph) and init_db; creates no client
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+
+# Wire compression is negotiated with the server in order of preference.
+COMPRESSION_OPTIONS = dict(compressors="zstd,snappy,zlib", zlibCompressionLevel=6)
@@ -0,0 +1,13 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+from dbconfig import MONGO_URI, COMPRESSION_OPTIONS
+
+# One client (and connection pool) per process, shared by the API and the graph agents.
+# Motor, so DB calls don't block the event loop; init_db.py opens its own sync client.
+async_client = AsyncIOMotorClient(
+    MONGO_URI,
+    maxPoolSize=50,
+    minPoolSize=5,
+    serverSelectionTimeoutMS=3000,
+    **COMPRESSION_OPTIONS
+)
+async_db = async_client.proximity_dispatch
@@ -8,6 +8,7 @@ class DispatchState(BaseModel):
     ticket: Dict[str, Any]
     customer: Optional[Dict[str, Any]] = None
     best: Optional[Dict[str, Any]] = None
+    top3: Optional[List[Dict[str, Any]]] = None
     llm_reason: Optional[str] = None
 
 # Build graph with only proximity flow
@@ -22,4 +23,5 @@ graph_builder.add_edge("load_customer", "compute_proximity")
 graph_builder.add_edge("compute_proximity", "assign")
 graph_builder.add_edge("assign", END)
 
+# Nodes are coroutines: run with `await graph.ainvoke(DispatchState(ticket=...))`
 graph = graph_builder.compile()
@@ -1,22 +1,22 @@
 from pymongo import MongoClient
-from dotenv import load_dotenv
+from pymongo.errors import BulkWriteError
+from dbconfig import MONGO_URI, COMPRESSION_OPTIONS
 import pandas as pd
-import os
 
-# Load environment variables
-load_dotenv()
-MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
-client = MongoClient(MONGO_URI)
+# One-shot script: its own synchronous client with no warm pool (the API's Motor client isn't needed here)
+client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=3000, **COMPRESSION_OPTIONS)
 db = client["proximity_dispatch"]
 
+BATCH_SIZE = 10_000
+
 # Step 1: Drop existing collections
 for name in ["customers", "technicians", "assignments"]:
     db[name].drop()
     print(f"🗑️ Dropped collection: {name}")
 
 # Step 2: Load CSVs
-customer_df = pd.read_csv("customer.csv")
-technician_df = pd.read_csv("Technician.csv")
+customer_df = pd.read_csv("customer.csv", engine="pyarrow")
+technician_df = pd.read_csv("Technician.csv", engine="pyarrow")
 
 # ✅ Rename for consistency in DB
 customer_df.rename(columns={"customer_id": "id"}, inplace=True)
@@ -34,13 +34,32 @@ customer_df["id"] = customer_df["id"].astype(int)
 technician_df["id"] = technician_df["id"].astype(int)
 
 # Step 3: Insert clean data into MongoDB
-db.customers.insert_many(customer_df.to_dict(orient="records"))
-db.technicians.insert_many(technician_df.to_dict(orient="records"))
+# Unordered batches let the server apply inserts in parallel; bad rows are
+# reported and skipped so the remaining batches and the index setup still run
+def insert_in_batches(collection, df):
+    for start in range(0, len(df), BATCH_SIZE):
+        batch = df.iloc[start:start + BATCH_SIZE].to_dict(orient="records")
+        try:
+            collection.insert_many(batch, ordered=False, bypass_document_validation=True)
+        except BulkWriteError as e:
+            errors = e.details["writeErrors"]
+            print(f"⚠️ {collection.name}: {len(errors)} row(s) rejected in batch starting at {start}")
+            for err in errors:
+                print(f"   row {start + err['index']}: {err['errmsg']}")
+
+insert_in_batches(db.customers, customer_df)
+insert_in_batches(db.technicians, technician_df)
 
 # Step 4: Create indexes
 db.customers.create_index("id", unique=True)
 db.technicians.create_index("id", unique=True)
-db.assignments.create_index("tech_id")
-db.assignments.create_index("customer_id")
+# Free-technician lookup; partial so only free techs are indexed and it stays small
+db.technicians.create_index([("is_free", 1), ("id", 1)], partialFilterExpression={"is_free": True})
+# Closing open assignments filters on (tech_id, status) / (customer_id, status)
+db.assignments.create_index([("tech_id", 1), ("status", 1)])
+db.assignments.create_index([("customer_id", 1), ("status", 1)])
+
+# Technicians were replaced: make running API workers rebuild their spatial index
+db.counters.update_one({"_id": "free_technicians"}, {"$inc": {"version": 1}}, upsert=True)
 
 print("✅ MongoDB initialized with cleaned customer and technician data.")
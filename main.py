@@ -1,47 +1,35 @@
-from fastapi import FastAPI, HTTPException, Body
-from pymongo import MongoClient
+from fastapi import FastAPI, HTTPException, Body, BackgroundTasks
 from dotenv import load_dotenv
-import openrouteservice
 import os
+import heapq
+import asyncio
 import logging
-import requests
+from contextlib import asynccontextmanager
 from fastapi import Body
+from dbconn import async_db
+from agents import SESSION, route_distances, find_nearest_free_technicians, load_tech_index, invalidate_tech_index, needs_llm_tiebreak, close_http_session
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI()
-logging.basicConfig(level=logging.INFO)
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    # Close the pooled ORS/OSRM session opened by the first dispatch
+    await close_http_session()
 
-# MongoDB Setup
-MONGO_URI = os.getenv("MONGO_URI")
-client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=3000)
-db = client["proximity_dispatch"]
-customers = db["customers"]
-technicians = db["technicians"]
-assignments = db["assignments"]
+app = FastAPI(lifespan=lifespan)
+logging.basicConfig(level=logging.INFO)
 
-# ORS Setup
-ORS_API_KEY = os.getenv("ORS_API_KEY")
+# MongoDB Setup (Motor, so DB calls don't block the event loop)
+customers = async_db["customers"]
+technicians = async_db["technicians"]
+assignments = async_db["assignments"]
 
 # Groq Setup
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 GROQ_MODEL = "mixtral-8x7b-32768"
 
-# ORS Distance
-def compute_distance_ors(coord1, coord2):
-    try:
-        ors_client = openrouteservice.Client(key=ORS_API_KEY)
-        route = ors_client.directions(
-            coordinates=[coord1, coord2],
-            profile='driving-car',
-            format='geojson'
-        )
-        return route['features'][0]['properties']['segments'][0]['distance'] / 1000, "ORS"
-    except Exception as e:
-        logging.error(f"\u274c ORS failed to compute distance: {e}")
-        return None, "ORS Failed"
-
 # LLM via Groq API
 def llm_recommend_best_technician(customer_id, top3):
     try:
@@ -65,32 +53,46 @@ def llm_recommend_best_technician(customer_id, top3):
             ]
         }
 
-        response = requests.post("https://api.groq.com/openai/v1/chat/completions", headers=headers, json=body)
+        response = SESSION.post("https://api.groq.com/openai/v1/chat/completions", headers=headers, json=body, timeout=30)
         result = response.json()
         tech_id_str = result["choices"][0]["message"]["content"].strip()
         tech_id = int(''.join(filter(str.isdigit, tech_id_str)))
         return tech_id
 
     except Exception as e:
-        logging.warning(f"LLM fallback: {e}")
-        return top3[0]["technician_id"]
+        logging.warning(f"LLM recommendation failed: {e}")
+        return None
+
+# Runs after the response is sent: records the LLM's pick on the assignment for review
+async def llm_annotate(assignment_id, customer_id, top3):
+    llm_id = await asyncio.to_thread(llm_recommend_best_technician, customer_id, top3)
+    if not any(t["technician_id"] == llm_id for t in top3):
+        return
+    await assignments.update_one({"_id": assignment_id}, {"$set": {"llm_recommended_id": llm_id}})
 
 # Recommend Technician Endpoint
 @app.get("/recommend")
-def recommend_technician(customer_id: int):
-    customer = customers.find_one({"id": customer_id})
+async def recommend_technician(customer_id: int, background_tasks: BackgroundTasks):
+    # Refresh the free-technician index while the customer lookup is in flight
+    customer, _ = await asyncio.gather(
+        customers.find_one({"id": customer_id}, {"latitude": 1, "longitude": 1}),
+        load_tech_index()
+    )
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
 
-    customer_coord = [customer["longitude"], customer["latitude"]]
-    free_techs = list(technicians.find({"is_free": True}))
+    customer_coord = (float(customer["latitude"]), float(customer["longitude"]))
+    free_techs = await find_nearest_free_technicians(*customer_coord, {"id": 1, "name": 1, "latitude": 1, "longitude": 1})
     if not free_techs:
         raise HTTPException(status_code=404, detail="No available technicians")
 
+    results = await route_distances(
+        customer_coord,
+        [(float(tech["latitude"]), float(tech["longitude"])) for tech in free_techs]
+    )
+
     distances = []
-    for tech in free_techs:
-        tech_coord = [tech["longitude"], tech["latitude"]]
-        distance, method = compute_distance_ors(customer_coord, tech_coord)
+    for tech, (distance, method) in zip(free_techs, results):
         if distance is not None:
             logging.info(f"Customer {customer_id} → Technician {tech['id']} ({tech['name']}) → {distance:.2f} km via {method}")
             distances.append({
@@ -100,36 +102,46 @@ def recommend_technician(customer_id: int):
                 "method": method
             })
         else:
-            logging.warning(f"❌ ORS distance failed for technician {tech['id']}")
+            logging.warning(f"❌ Distance failed for technician {tech['id']}")
 
     if not distances:
         raise HTTPException(status_code=500, detail="No distances could be computed")
 
-    top3 = sorted(distances, key=lambda x: x["distance_km"])[:3]
-    best_id = llm_recommend_best_technician(customer_id, top3)
-    best = next(t for t in top3 if t["technician_id"] == best_id)
-
-    technicians.update_one(
-        {"id": best["technician_id"]},
-        {"$set": {
-            "is_free": False,
-            "assigned_customer": customer_id,
-            "availability_status": "assigned"
-        }}
-    )
+    top3 = heapq.nsmallest(3, distances, key=lambda x: x["distance_km"])
+
+    # Nearest technician wins; claim atomically so two concurrent requests
+    # can never assign the same technician
+    best = None
+    for candidate in top3:
+        claimed = await technicians.find_one_and_update(
+            {"id": candidate["technician_id"], "is_free": True},
+            {"$set": {
+                "is_free": False,
+                "assigned_customer": customer_id,
+                "availability_status": "assigned"
+            }},
+            projection={"_id": 1}
+        )
+        if claimed:
+            best = candidate
+            break
+    if best is None:
+        raise HTTPException(status_code=409, detail="Nearest technicians were assigned by another request")
 
-    assignments.insert_one({
+    assignment = await assignments.insert_one({
         "tech_id": best["technician_id"],
         "customer_id": customer_id,
         "distance_km": best["distance_km"],
         "method": best["method"],
         "status": "assigned"
     })
+    if needs_llm_tiebreak(top3):
+        background_tasks.add_task(llm_annotate, assignment.inserted_id, customer_id, top3)
 
     return {
         "top3": top3,
         "best_id": best["technician_id"],
-        "reason": f"Groq LLM recommended technician {best['name']} as the best match using ORS distance."
+        "reason": f"Assigned nearest technician {best['name']} by {best['method']} distance."
     }
 
 # Complete Assignment Endpoint
@@ -137,8 +149,8 @@ def recommend_technician(customer_id: int):
 
 
 @app.post("/complete-assignment")
-def complete_assignment(technician_id: int = Body(...)):
-    technician = technicians.find_one({"id": technician_id})
+async def complete_assignment(technician_id: int = Body(...)):
+    technician = await technicians.find_one({"id": technician_id}, {"is_free": 1})
     if not technician:
         raise HTTPException(status_code=404, detail="Technician not found")
 
@@ -149,7 +161,7 @@ def complete_assignment(technician_id: int = Body(...)):
         }
 
     # 1. Mark technician as free and available
-    technicians.update_one(
+    await technicians.update_one(
         {"id": technician_id},
         {"$set": {
             "is_free": True,
@@ -158,8 +170,10 @@ def complete_assignment(technician_id: int = Body(...)):
         }}
     )
 
+    await invalidate_tech_index()
+
     # 2. Mark any ongoing assignments as completed
-    result = assignments.update_many(
+    result = await assignments.update_many(
         {"tech_id": technician_id, "status": {"$ne": "completed"}},
         {"$set": {"status": "completed"}}
     )
@@ -0,0 +1,86 @@
+import asyncio
+import math
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length=None):
+        return list(self.docs)
+
+
+class FakeTechnicians:
+    def __init__(self, docs):
+        self.docs = {d["_id"]: d for d in docs}
+
+    def find(self, query, projection=None):
+        docs = [d for d in self.docs.values() if d["is_free"]]
+        if "_id" in query:
+            docs = [d for d in docs if d["_id"] in query["_id"]["$in"]]
+        return FakeCursor([dict(d) for d in docs])
+
+
+class FakeCounters:
+    async def find_one(self, query, projection=None):
+        return None
+
+
+fake_db = types.SimpleNamespace(technicians=FakeTechnicians([]), counters=FakeCounters())
+sys.modules.setdefault("dbconn", types.SimpleNamespace(async_client=None, async_db=fake_db))
+
+import agents  # noqa: E402
+
+
+def use_fleet(docs):
+    agents.async_db.technicians = FakeTechnicians(docs)
+    agents._tech_tree = None
+    agents._tech_ids = []
+    agents._tech_version = None
+
+
+def fleet(n):
+    # Technicians due north of (10, 10), each a little farther than the last
+    return [{"_id": i, "latitude": 10 + i * 0.01, "longitude": 10.0, "is_free": True} for i in range(n)]
+
+
+def nearest_ids(k=agents.NEAREST_K):
+    techs = asyncio.run(agents.find_nearest_free_technicians(10.0, 10.0, None, k=k))
+    return [t["_id"] for t in techs]
+
+
+def test_nan_coordinates_are_left_out_of_the_index():
+    docs = fleet(5)
+    docs[1]["latitude"] = math.nan
+    docs[3]["longitude"] = None
+    use_fleet(docs)
+
+    assert nearest_ids() == [0, 2, 4]
+
+
+def test_search_widens_past_assigned_technicians():
+    docs = fleet(30)
+    use_fleet(docs)
+    assert nearest_ids() == list(range(10))
+
+    # Claimed after the index was built: still in the tree, filtered by is_free
+    for doc in docs[:8]:
+        doc["is_free"] = False
+
+    assert nearest_ids() == list(range(8, 18))
+
+
+def test_search_stops_when_index_is_exhausted():
+    docs = fleet(12)
+    use_fleet(docs)
+    assert nearest_ids(k=3) == [0, 1, 2]
+
+    for doc in docs[:10]:
+        doc["is_free"] = False
+
+    assert nearest_ids(k=3) == [10, 11]